@@ -1,11 +1,31 @@
 import json
 import os
 import re
+import stat
 import sys
-from typing import Union, Optional, List
+from typing import Dict, Union, Optional, List, Tuple
 
 MAX_CONVERT_THREADS = 512  # Just an upper bound for max_conversion_threads sanity.
 
+_THREADS_RE = re.compile(r"(?:\d+)|(?:cpus *(?:([+\-*/]) *(\d+))?)")
+
+# Accepted value types per config key. max_conversion_threads is left out, it has its
+# own lenient evaluation in Config._eval_max_threads_expr().
+_CONFIG_SCHEMA: Dict[str, Union[type, Tuple[type, ...]]] = {
+    "audio": (str, list),
+    "output": str,
+    "extensions": list,
+    "wants": str,
+    "database": str,
+    "covers": str,
+    "ffmpeg_bin": str,
+    "link_files": bool,
+    "scan_for_covers": bool,
+    "cover_max_dimension": int,
+    "cover_scan_cache_size": int,
+    "cover_cache_dir": str,
+}
+
 
 class Config:
     """
@@ -23,10 +43,16 @@ class Config:
                     ".songfone/songs.wants".
     * database      The name of the SQLite database file. Defaults to
                     ".songfone/songs.db".
+    * covers        The name of the directory for the database's cover images. Defaults
+                    to ".songfone/covers".
     * ffmpeg_bin    The ffmpeg binary to use for conversion. Defaults to "ffmpeg".
     * max_conversion_threads
                     A number or expression that sets the maximum number of threads to
                     use for converting audio files.
+    * link_files    Whether to hard link wanted files into the output dir instead of
+                    copying them, where possible. Saves time and space, but since the
+                    output dir is synced both ways, any change to a synced file then
+                    also changes the file in the audio dir. Defaults to false.
     * scan_for_covers
                     Whether to look for image files with cover art for each audio file.
     * cover_max_dimension
@@ -41,6 +67,10 @@ class Config:
                     later on, the image will be loaded (and possibly resized) twice or
                     more. Assuming a somewhat sane directory structure, it's safe to
                     keep this fairly low. Defaults to 5. Should be insignificant.
+    * cover_cache_dir
+                    A directory to keep resized cover images in, so they don't have to
+                    be resized again on the next scan. Defaults to
+                    "~/.cache/songfone/covers".
 
     >>> c = Config()
     >>> c.database
@@ -52,11 +82,14 @@ class Config:
     extensions: List[str] = ["mp3", "flac", "mp4", "ogg", "opus"]
     wants: str = ".songfone/songs.wants"
     database: str = ".songfone/songs.db"
+    covers: str = ".songfone/covers"
     ffmpeg_bin: str = "ffmpeg"  # default: ffmpeg is in $PATH
     max_conversion_threads: int = 2
+    link_files: bool = False
     scan_for_covers: bool = True
     cover_max_dimension: int = 512
     cover_scan_cache_size: int = 5
+    cover_cache_dir: str = "~/.cache/songfone/covers"
     _error: Optional[Exception] = None
 
     def load(self, file: str) -> None:
@@ -67,13 +100,65 @@ class Config:
 
     def _load_from_file(self, file):
         try:
-            with open(file) as config_file:
-                config = json.load(config_file)
-        except (json.JSONDecodeError, FileNotFoundError, PermissionError) as err:
-            self._error = err
+            with open(file, "rb") as config_file:
+                config = {
+                    key.replace(" ", "_"): value
+                    for key, value in json.loads(config_file.read()).items()
+                }
+            self._validate(config)
+        except (
+            json.JSONDecodeError,
+            FileNotFoundError,
+            PermissionError,
+            TypeError,
+        ) as err:
+            self._fail(err)
             raise err
         for key, value in config.items():
-            setattr(self, key.replace(" ", "_"), value)
+            setattr(self, key, value)
+
+    @staticmethod
+    def _validate(config: dict) -> None:
+        """Check the types of all known keys in a single pass over the loaded config.
+
+        >>> Config._validate({"audio": ["~/Music"], "scan_for_covers": False})
+        >>> Config._validate({"cover_max_dimension": "512"})
+        Traceback (most recent call last):
+        ...
+        TypeError: Config value for 'cover_max_dimension' must be int, not str
+        >>> Config._validate({"cover_max_dimension": True})
+        Traceback (most recent call last):
+        ...
+        TypeError: Config value for 'cover_max_dimension' must be int, not bool
+        >>> Config._validate({"extensions": ["mp3", 4]})
+        Traceback (most recent call last):
+        ...
+        TypeError: Config values in 'extensions' must be str, not int
+        """
+        for key, value in config.items():
+            expected = _CONFIG_SCHEMA.get(key)
+            if expected is None:
+                continue
+            # bool is a subclass of int, but true/false are no numbers
+            if not isinstance(value, expected) or (
+                isinstance(value, bool) and expected is int
+            ):
+                names = (
+                    " or ".join(t.__name__ for t in expected)
+                    if isinstance(expected, tuple)
+                    else expected.__name__
+                )
+                raise TypeError(
+                    f"Config value for {key!r} must be {names},"
+                    f" not {type(value).__name__}"
+                )
+            if isinstance(value, list):
+                for item in value:
+                    if not isinstance(item, str):
+                        raise TypeError(
+                            f"Config values in {key!r} must be str,"
+                            f" not {type(item).__name__}"
+                        )
 
     def _set_file_paths(self):
         if isinstance(self.audio, str):
@@ -81,20 +166,22 @@ class Config:
         elif isinstance(self.audio, list):
             self.audio = [os.path.expanduser(a) for a in self.audio]
         self.output = os.path.expanduser(self.output)
+        self.cover_cache_dir = os.path.expanduser(self.cover_cache_dir)
+        # For joining relative song paths onto the output dir with a plain concatenation
+        self.output_prefix = os.path.join(self.output, "")
         self.wants_file = os.path.join(self.output, self.wants)
         self.database_file = os.path.join(self.output, self.database)
+        self.covers_dir = os.path.join(self.output, self.covers)
 
     def _check_audio_dir(self):
         for a in self.audio:
-            if not os.path.isdir(a):
+            if not _is_dir(a):
                 raise FileNotFoundError(f"Error, audio directory {a!r} does not exist")
 
     def _eval_max_threads_expr(self):
         if isinstance(self.max_conversion_threads, str):
             config_str_value = self.max_conversion_threads.lower()
-            match = re.fullmatch(
-                r"(?:\d+)|(?:cpus *(?:([+\-*/]) *(\d)+)?)", config_str_value
-            )
+            match = _THREADS_RE.fullmatch(config_str_value)
             if match is not None:
                 if "cpus" not in config_str_value:
                     self.max_conversion_threads = int(config_str_value)
@@ -149,29 +236,51 @@ class Config:
             )
             self.max_conversion_threads = 1
 
-    def __getattribute__(self, key: str):
-        err = super().__getattribute__("_error")
-        if err is not None:
-            raise RuntimeError(f"Config file could not be parsed: {err}")
-        return super().__getattribute__(key)
+    def _fail(self, err: Exception) -> None:
+        """Put the config into an error state, in which any further attribute access
+        raises. Only the broken config pays for the check on attribute access.
+        """
+        self._error = err
+        self.__class__ = _BrokenConfig
 
     def make_output(self):
         """Create the output dir, and return True on success, False otherwise."""
         try:
-            try:
+            if not _is_dir(self.output):
                 os.mkdir(self.output)
+            for path in {
+                os.path.dirname(self.wants_file),
+                os.path.dirname(self.database_file),
+                self.covers_dir,
+            }:
+                if not _is_dir(path):
+                    os.makedirs(path, exist_ok=True)
+            try:
+                with open(self.wants_file, "x") as new_wants:
+                    print("{}", file=new_wants)
             except FileExistsError:
                 pass
-            os.makedirs(os.path.dirname(self.wants_file), exist_ok=True)
-            os.makedirs(os.path.dirname(self.database_file), exist_ok=True)
-            if not os.path.exists(self.wants_file):
-                with open(self.wants_file, "a") as new_wants:
-                    print("{}", file=new_wants)
         except Exception as err:
-            self._error = err
+            self._fail(err)
             raise err
 
 
+class _BrokenConfig(Config):
+    """A config that failed to load. See Config._fail()."""
+
+    def __getattribute__(self, key: str):
+        err = object.__getattribute__(self, "_error")
+        raise RuntimeError(f"Config file could not be parsed: {err}")
+
+
+def _is_dir(path: str) -> bool:
+    """Return True if *path* is a directory, using a single stat() call."""
+    try:
+        return stat.S_ISDIR(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
 config = Config()
 
 
@@ -1,12 +1,15 @@
 import os
 from shutil import which
-from subprocess import run, PIPE, STDOUT
+from subprocess import run, DEVNULL
 import sys
-from typing import Iterable, List, Optional
+from typing import Iterable, List, Optional, TYPE_CHECKING
 
 from config import config
 from database import get_song_tags
 
+if TYPE_CHECKING:
+    from wants import Want
+
 
 class Conversion:
     """
@@ -19,6 +22,8 @@ class Conversion:
         quality (`int`): The codec sample rate in bits per second.
     """
 
+    __slots__ = ("ext", "dot_ext", "ffmpeg_codec", "quality")
+
     _codecs_ext_eq = ["mp3", "flac", "mp4", "m4a"]
     _codecs_ext_neq = {"ogg": "libvorbis", "opus": "libopus"}
     valid_codecs = _codecs_ext_eq + list(_codecs_ext_neq.keys())
@@ -27,6 +32,7 @@ class Conversion:
         self.ext = ext.lower()
         if self.ext not in self.valid_codecs:
             raise ValueError(f"Unknown audio extension {self.ext}")
+        self.dot_ext = "." + self.ext  # Appended to each converted want's path
         self.ffmpeg_codec = (
             self.ext
             if self.ext in self._codecs_ext_eq
@@ -43,22 +49,34 @@ class Conversion:
         tags: Optional[dict] = None,
     ) -> bool:
         """Run the conversion. Return 0 on success."""
-        cmd: List[str] = [
-            config.ffmpeg_bin,
-            "-y",
-            "-i",
-            src,
-            "-c:a",
-            codec,
-            "-b:a",
-            str(bitrate),
-            dest,
-        ]
+        cmd: List[str] = [config.ffmpeg_bin, "-y", "-i", src]
+        cmd += self._ffmpeg_output_args(0, dest, codec, bitrate, tags)
+        conversion = run(cmd, stdout=DEVNULL, stderr=DEVNULL)
+        return conversion.returncode == 0
+
+    @staticmethod
+    def _ffmpeg_output_args(
+        input_index: int,
+        dest: str,
+        codec: str,
+        bitrate: int,
+        tags: Optional[dict] = None,
+    ) -> List[str]:
+        """Return the ffmpeg arguments for an output, *dest*, of the input with the
+        given index. Only the audio is converted, e.g. embedded cover images are not,
+        in single as well as in batched conversions.
+        Without -map_metadata and -map_chapters, every output of a batch would get the
+        tags and chapters of the first input.
+        """
+        args: List[str] = ["-map", f"{input_index}:a"]
+        args += ["-map_metadata", str(input_index), "-map_chapters", str(input_index)]
+        args += ["-c:a", codec, "-b:a", str(bitrate)]
         if tags is not None:
             for field, value in tags.items():
-                cmd += ["-metadata", f'{field}="{value}"']
-        conversion = run(cmd, stdout=PIPE, stderr=STDOUT)
-        return conversion.returncode == 0
+                # Arguments go to ffmpeg as-is, any quotes would end up in the tag
+                value = str(value).replace("\r", "").replace("\n", " ")
+                args += ["-metadata", f"{field}={value}"]
+        return args + [dest]
 
     @staticmethod
     def ffmpeg_available() -> bool:
@@ -67,19 +85,62 @@ class Conversion:
 
     def do(self, want: "Want") -> bool:
         """Run the conversion. Return 0 on success."""
+        src_file = os.path.join(want.audio_dir, want.src_path)
+        dest_file = config.output_prefix + want.path
         if not self.ffmpeg_available():
             print("ffmpeg not available, conversions not possible", file=sys.stderr)
             return False
-        src_file = os.path.join(want.audio_dir, want.src_path)
         print(f"Converting {want.path}")
         success: bool = self.ffmpeg(
             src=src_file,
-            dest=os.path.join(config.output, want.path),
+            dest=dest_file,
             codec=self.ffmpeg_codec,
             bitrate=self.quality,
             # tags=get_song_tags(want.src_path),
         )
         return success
 
+    def do_many(self, wants: List["Want"]) -> List[bool]:
+        """Run the conversion for several wants in a single ffmpeg process, to only pay
+        for the ffmpeg startup once. Return a success value for each want.
+        If the combined run fails, each want is converted on its own, so that failures
+        can be attributed to the individual files.
+
+        >>> from wants import Want
+        >>> conversion = Conversion("ogg", 96000)
+        >>> wants = [Want("/music", f"a/{n}.flac", conversion) for n in (1, 2)]
+        >>> config.output_prefix, config.ffmpeg_bin = "/out/", "true"
+        >>> conversion.do_many(wants)
+        Converting a/1.ogg
+        Converting a/2.ogg
+        [True, True]
+        >>> config.ffmpeg_bin = "false"  # the batch fails, and so does each retry
+        >>> conversion.do_many(wants)
+        Converting a/1.ogg
+        Converting a/2.ogg
+        Converting a/1.ogg
+        Converting a/2.ogg
+        [False, False]
+        >>> config.ffmpeg_bin = "ffmpeg"
+        """
+        if len(wants) <= 1:
+            return [self.do(want) for want in wants]
+        if not self.ffmpeg_available():
+            print("ffmpeg not available, conversions not possible", file=sys.stderr)
+            return [False] * len(wants)
+        output_prefix = config.output_prefix
+        cmd: List[str] = [config.ffmpeg_bin, "-y"]
+        for want in wants:
+            cmd += ["-i", os.path.join(want.audio_dir, want.src_path)]
+        for input_index, want in enumerate(wants):
+            print(f"Converting {want.path}")
+            cmd += self._ffmpeg_output_args(
+                input_index, output_prefix + want.path, self.ffmpeg_codec, self.quality
+            )
+        if run(cmd, stdout=DEVNULL, stderr=DEVNULL).returncode != 0:
+            # Outputs of the failed run may be partially written, overwrite them all.
+            return [self.do(want) for want in wants]
+        return [True] * len(wants)
+
     def __str__(self) -> str:
         return f"in {self.ext.upper()}@{self.quality//1024}kbps"
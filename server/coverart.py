@@ -1,18 +1,113 @@
-from collections import OrderedDict
+from hashlib import sha256
 from io import BytesIO
 import os
 from PIL import Image  # type: ignore
 import re
 import sys
-from typing import Optional, Iterable, List
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Any, Dict, Optional, Iterable, List, Pattern, Tuple
 
 from config import config
 
+# Names of the files written by CoverArt.save_data(): sha256 hex digest and format
+COVER_FILE_RE = re.compile(r"[0-9a-f]{64}\.[a-z]+")
+
 
 class CoverNotFoundError(FileNotFoundError):
     pass
 
 
+class SieveDict:
+    """
+    A dict that holds at most *maxsize* items and evicts them with the SIEVE policy.
+
+    Items are kept in insertion order and marked as visited when read. To make room,
+    a "hand" sweeps from older to newer items, unmarking visited ones, and evicts the
+    first unvisited item. Unlike LRU, an item that was read again survives a library
+    scan looping over more albums than fit into the cache.
+
+    >>> cache = SieveDict(2)
+    >>> cache["a"], cache["b"] = 1, 2
+    >>> cache["a"]
+    1
+    >>> cache["c"] = 3
+    >>> "a" in cache, "b" in cache, "c" in cache
+    (True, False, True)
+
+    If all items were read, the hand unmarks them all, wraps around to the oldest one
+    and evicts it. The next eviction continues where the hand stopped:
+
+    >>> cache = SieveDict(3)
+    >>> cache["a"], cache["b"], cache["c"] = 1, 2, 3
+    >>> cache["a"], cache["b"], cache["c"]
+    (1, 2, 3)
+    >>> cache["d"] = 4
+    >>> [key for key in "abcdef" if key in cache]
+    ['b', 'c', 'd']
+    >>> cache["c"]
+    3
+    >>> cache["e"] = 5
+    >>> cache["f"] = 6
+    >>> [key for key in "abcdef" if key in cache]
+    ['c', 'e', 'f']
+    """
+
+    # Node layout: [older node, newer node, key, value, visited]
+    _OLDER, _NEWER, _KEY, _VALUE, _VISITED = range(5)
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._nodes: Dict[Any, list] = {}
+        self._oldest: Optional[list] = None
+        self._newest: Optional[list] = None
+        self._hand: Optional[list] = None
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __contains__(self, key) -> bool:
+        return key in self._nodes
+
+    def __getitem__(self, key):
+        node = self._nodes[key]
+        node[self._VISITED] = True
+        return node[self._VALUE]
+
+    def __setitem__(self, key, value):
+        node = self._nodes.get(key)
+        if node is not None:
+            node[self._VALUE] = value
+            node[self._VISITED] = True
+            return
+        if self._nodes and len(self._nodes) >= self.maxsize:
+            self._evict()
+        node = [self._newest, None, key, value, False]
+        if self._newest is None:
+            self._oldest = node
+        else:
+            self._newest[self._NEWER] = node
+        self._newest = node
+        self._nodes[key] = node
+
+    def _evict(self):
+        node = self._hand or self._oldest
+        while node[self._VISITED]:
+            node[self._VISITED] = False
+            node = node[self._NEWER] or self._oldest
+        self._hand = node[self._NEWER]
+        older, newer = node[self._OLDER], node[self._NEWER]
+        if older is None:
+            self._oldest = newer
+        else:
+            older[self._NEWER] = newer
+        if newer is None:
+            self._newest = older
+        else:
+            newer[self._OLDER] = older
+        del self._nodes[node[self._KEY]]
+
+
 class CoverArt:
     """
     >>> cover = CoverArt(
@@ -25,11 +120,34 @@ class CoverArt:
     b'\x01\x02...'
     """
 
+    __slots__ = (
+        "audio_dir",
+        "image_path",
+        "image_mtime",
+        "image_data",
+        "data_file",
+        "_lock",
+    )
+
     standard_names: List[str] = ["cover", "folder"]
     extensions: List[str] = ["png", "jpeg", "jpg", "bmp", "gif"]
+    _extensions_tuple: Tuple[str, ...] = tuple("." + ext for ext in extensions)
+    _standard_names_re: Pattern[str] = re.compile(
+        "|".join(map(re.escape, standard_names))
+    )
+
+    # (audio dir, image path) -> CoverArt, set up on first use, see _get_or_create()
+    _instances: Optional[SieveDict] = None
+    # (file dir, file dir mtime, parent dir mtime) -> {hints: image path or None}
+    # Set up on first use, like _instances.
+    _search_cache: Optional[SieveDict] = None
 
-    _cache: OrderedDict = OrderedDict()
-    _cache_capacity = config.cover_scan_cache_size
+    audio_dir: str
+    image_path: str
+    image_mtime: Optional[int]
+    image_data: Optional[bytes]
+    data_file: Optional[str]
+    _lock: Lock
 
     def __new__(
         cls, audio_dir: str, audio_relpath: str, hints: Optional[Iterable[str]] = None
@@ -49,60 +167,121 @@ class CoverArt:
         if image_abspath is None:
             raise CoverNotFoundError(f"No cover art for {audio_path!r}")
         image_path = os.path.relpath(image_abspath, audio_dir)
-        if image_path not in cls._cache:
-            cls._cache[image_path] = super().__new__(cls)
-            cls._cache[image_path].image_path = image_path
-        else:
-            cls._cache.move_to_end(image_path)
-        if len(cls._cache) > config.cover_scan_cache_size:
-            oldest = next(iter(cls._cache))
-            del cls._cache[oldest]
-        return cls._cache[image_path]
+        return cls._get_or_create(audio_dir, image_path)
 
     def __init__(self, audio_dir: str, *args):
-        self.audio_dir = audio_dir
-        self.image_mtime: Optional[int] = None
-        self.image_data: Optional[BytesIO] = None
-        self.image_path: str  # set in __new__, declared here for typing
+        pass  # The instance may be a cached one, attributes are set in _create().
+
+    @classmethod
+    def _get_or_create(cls, audio_dir: str, image_path: str) -> "CoverArt":
+        # The cache is created on first use instead of at import time, so that it
+        # picks up the cache size from the loaded config file.
+        if cls._instances is None:
+            cls._instances = SieveDict(config.cover_scan_cache_size)
+        key = (audio_dir, image_path)
+        try:
+            return cls._instances[key]
+        except KeyError:
+            cover = cls._instances[key] = cls._create(audio_dir, image_path)
+            return cover
+
+    @classmethod
+    def _create(cls, audio_dir: str, image_path: str) -> "CoverArt":
+        cover = super().__new__(cls)
+        cover.audio_dir = audio_dir
+        cover.image_path = image_path
+        cover.image_mtime = None
+        cover.image_data = None
+        cover.data_file = None
+        cover._lock = Lock()
+        return cover
 
     @classmethod
     def _search(cls, audio_path: str, hints: Iterable[str]) -> Optional[str]:
         """Search for coverart files and return the best candidate.
         Searches dir containing the file and, if no images were found among sibling
         files, the parent directory too.
+        Results are cached per directory until either directory changes, so songs in
+        the same album directory only trigger a single search.
         """
         file_dir = os.path.dirname(audio_path)
         parent_dir = os.path.dirname(file_dir)
-        candidates = []
-        max_filesize: Optional[int] = None
-        for path in [file_dir, parent_dir]:
-            for file in os.listdir(path):
-                filename_lower = file.lower()
-                if not any([filename_lower.endswith(ext) for ext in cls.extensions]):
-                    continue
-                filepath = os.path.join(path, file)
-                filesize = os.stat(filepath).st_size
-                candidates.append((filepath, filename_lower, filesize))
-                if max_filesize is None or filesize > max_filesize:
-                    max_filesize = filesize
-            if candidates:
-                break
+        hints_key = tuple(hints)
+        try:
+            dir_key = (
+                file_dir,
+                os.stat(file_dir).st_mtime_ns,
+                os.stat(parent_dir).st_mtime_ns,
+            )
+        except OSError:
+            return cls._search_dirs(file_dir, parent_dir, hints_key)
+        if cls._search_cache is None:
+            cls._search_cache = SieveDict(config.cover_scan_cache_size)
+        try:
+            results = cls._search_cache[dir_key]
+        except KeyError:
+            results = cls._search_cache[dir_key] = {}
+        if hints_key not in results:
+            results[hints_key] = cls._search_dirs(file_dir, parent_dir, hints_key)
+        return results[hints_key]
+
+    @classmethod
+    def _search_dirs(
+        cls, file_dir: str, parent_dir: str, hints: Iterable[str]
+    ) -> Optional[str]:
+        # The parent dir is only listed if the file dir has no images.
+        candidates = cls._list_images(file_dir) or cls._list_images(parent_dir)
+        max_filesize = max([c[2] for c in candidates], default=None)
         if candidates and max_filesize:
-            rating = lambda c: cls._rate_as_cover_file(c[1], hints, c[2], max_filesize)
+            unique_hints = cls._unique_hints(hints)
+            rating = lambda c: cls._rate_as_cover_file(
+                c[1], unique_hints, c[2], max_filesize
+            )
             candidates.sort(key=rating, reverse=True)
             return candidates[0][0]
         return None
 
+    @classmethod
+    def _list_images(cls, path: str) -> List[Tuple[str, str, int]]:
+        """Return (path, lowercase filename, filesize) for all images in *path*."""
+        images = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                filename_lower = entry.name.lower()
+                if not filename_lower.endswith(cls._extensions_tuple):
+                    continue
+                if not entry.is_file():  # uses the dirent type, no extra syscall
+                    continue
+                images.append((entry.path, filename_lower, entry.stat().st_size))
+        return images
+
+    @staticmethod
+    def _unique_hints(hints: Iterable[str]) -> Tuple[str, ...]:
+        """Return the distinct, non-empty hints, once per search instead of per rating.
+
+        >>> CoverArt._unique_hints(["queen", "", "queen ii", "queen"])
+        ('queen', 'queen ii')
+        """
+        return tuple(dict.fromkeys(hint for hint in hints if hint))
+
     @classmethod
     def _rate_as_cover_file(
-        cls, filename_lower: str, hints: Iterable[str], filesize: int, max_filesize: int
+        cls,
+        filename_lower: str,
+        unique_hints: Tuple[str, ...],
+        filesize: int,
+        max_filesize: int,
     ) -> float:
+        """
+        Each hint found in the file name counts, also when one hint contains another.
+
+        >>> CoverArt._rate_as_cover_file("queen ii.jpg", ("queen", "queen ii"), 0, 1)
+        0.6
+        """
         rating = 0.0
-        if any([n in filename_lower for n in cls.standard_names]):
+        if cls._standard_names_re.search(filename_lower):
             rating += 0.6
-        for hint in hints:
-            if hint in filename_lower:
-                rating += 0.3
+        rating += 0.3 * sum(hint in filename_lower for hint in unique_hints)
         rating += (filesize / max_filesize) * 0.5
         ### Checking for image size is quite expensive. Turn it off, and rely on
         ### filesize as a rough gauge for image quality.
@@ -115,22 +294,80 @@ class CoverArt:
         """Load (and possibly resize to fit cover_max_dimension) the cover image.
         Returns the bytes of the image file in the given *image_format*, or None on
         error.
+        Resized images are kept in config.cover_cache_dir, so they are only decoded and
+        encoded again if the image file changes.
         """
         if self.image_data is not None:
-            return self.image_data.getvalue()
-        self.image_data = BytesIO()
+            return self.image_data
+        # Concurrent requests for the same cover wait for the first one to load it.
+        with self._lock:
+            if self.image_data is None:
+                self.image_data = self._read_data(image_format)
+            return self.image_data
+
+    def save_data(self, directory: str, image_format="JPEG") -> Optional[str]:
+        """Write the cover image data (see get_data()) to a file in *directory* that is
+        named after the sha256 hash of the data, and return the file's name, or None on
+        error. Identical images are only stored once, and existing files aren't written
+        again.
+        """
+        if self.data_file is not None:
+            return self.data_file
+        data = self.get_data(image_format)
+        if data is None:
+            return None
+        data_file = sha256(data).hexdigest() + "." + image_format.lower()
+        data_path = os.path.join(directory, data_file)
+        if not os.path.exists(data_path) and not _write_atomic(data_path, data):
+            return None
+        self.data_file = data_file
+        return data_file
+
+    def _read_data(self, image_format: str) -> Optional[bytes]:
+        image_abspath = os.path.join(self.audio_dir, self.image_path)
         try:
-            image = Image.open(os.path.join(self.audio_dir, self.image_path))
-            if any([s > config.cover_max_dimension for s in image.size]):
-                scale = config.cover_max_dimension / max(image.size)
-                image = image.resize(
-                    (int(image.size[0] * scale), int(image.size[1] * scale)),
-                    Image.LANCZOS,
-                )
-            image.save(self.image_data, image_format)
+            self.image_mtime = os.stat(image_abspath).st_mtime_ns
+        except OSError as err:
+            print(
+                f"Warning, image data load/save failed for {self.image_path}:",
+                err,
+                file=sys.stderr,
+            )
+            return None
+        cache_file = self._cache_file(image_abspath, image_format)
+        cache_version = self._cache_version()
+        try:
+            with open(cache_file, "rb") as cached:
+                if cached.readline() == cache_version:
+                    return cached.read()
+        except OSError:
+            pass
+        return self._load_data(image_abspath, image_format, cache_file)
+
+    def _load_data(
+        self, image_abspath: str, image_format: str, cache_file: str
+    ) -> Optional[bytes]:
+        buffer = BytesIO()
+        try:
+            image = Image.open(image_abspath)
+            max_dimension = config.cover_max_dimension
+            if image.format == image_format and all(
+                s <= max_dimension for s in image.size
+            ):
+                # Already small enough and in the right format, use the file as-is.
+                with open(image_abspath, "rb") as image_file:
+                    return image_file.read()
+            # With reducing_gap, thumbnail() lets JPEGs decode at a reduced DCT scale
+            # (via draft()) and pre-reduces large images with a cheap box filter, still
+            # at least twice the target size, before the LANCZOS pass.
+            image.thumbnail(
+                (max_dimension, max_dimension), Image.LANCZOS, reducing_gap=2.0
+            )
+            image.save(buffer, image_format)
         except OSError as err:
             if "cannot write mode" in str(err):
-                image.convert("RGB").save(self.image_data, image_format)
+                buffer = BytesIO()
+                image.convert("RGB").save(buffer, image_format)
             else:
                 # e.g. "image file is truncated", or other image loading/saving errors
                 print(
@@ -139,8 +376,26 @@ class CoverArt:
                     file=sys.stderr,
                 )
                 return None
+        image_data = buffer.getvalue()
+        _write_atomic(cache_file, self._cache_version() + image_data)
+        return image_data
+
+    @staticmethod
+    def _cache_file(image_abspath: str, image_format: str) -> str:
+        """Return the cache file for the image. There is only one per image, a new
+        version of the image replaces the older one, see _cache_version().
+        """
+        key = image_abspath + "\0" + image_format
+        return os.path.join(
+            config.cover_cache_dir,
+            sha256(key.encode()).hexdigest() + "." + image_format.lower(),
+        )
 
-        return self.image_data.getvalue()
+    def _cache_version(self) -> bytes:
+        """Return the first line of the cache file, which must match for the cached data
+        to be used: the image's mtime and the size setting.
+        """
+        return f"{self.image_mtime} {config.cover_max_dimension}\n".encode()
 
     def __hash__(self) -> int:
         return hash(self.image_path)
@@ -152,3 +407,18 @@ class CoverArt:
             return self.image_path == other.image_path
         except AttributeError:
             return False
+
+
+def _write_atomic(path: str, data: bytes) -> bool:
+    """Write *data* to a temporary file next to *path*, then move it into place.
+    Errors are only reported, and False returned.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as tmp:
+            tmp.write(data)
+        os.replace(tmp.name, path)
+        return True
+    except OSError as err:
+        print(f"Warning, could not write file {path!r}:", err, file=sys.stderr)
+        return False
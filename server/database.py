@@ -1,102 +1,291 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
 import os
 import sys
-from glob import glob
 import sqlite3
+import threading
 import mutagen  # type: ignore
 from mutagen.mp3 import MP3  # type: ignore
 from mutagen.easyid3 import EasyID3  # type: ignore
+from functools import lru_cache
 from hashlib import sha256
-from typing import List, Dict
-from typing import Iterable, MutableMapping, Any, Optional
+from typing import Callable, List, Dict, Tuple
+from typing import Iterable, Iterator, MutableMapping, Any, NamedTuple, Optional
 
 from config import config
-from coverart import CoverArt, CoverNotFoundError
+from coverart import COVER_FILE_RE, CoverArt, CoverNotFoundError
 from dirs import list_files_relative
 
 
+SCAN_PROCESSES = os.cpu_count() or 1  # Processes for reading metadata
+
+# Per-thread database connections for reading, see _read_connection()
+_thread_local = threading.local()
+
+# Upserts with RETURNING need SQLite 3.35, _upsert() falls back to SELECT+UPDATE/INSERT
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# For str.translate(), to delete all control characters below 0x20 from tag values
+_CONTROL_CHARS = dict.fromkeys(range(0x20))
+# Tags that would clash with the song table's columns
+_SKIPPED_TAGS = frozenset(["path", "codec", "filesize", "mtime"])
+# Tags whose values help to pick a song's cover image
+_COVER_HINT_TAGS = frozenset(["artist", "album", "album_artist", "albumartist"])
+
+# Bump this whenever DB_LAYOUT changes. Databases with a different version are cleared
+# and rebuilt by a full rescan.
+DB_VERSION = 5
+
 DB_LAYOUT = """
     CREATE TABLE IF NOT EXISTS audio_dir (
-        path_hash NOT NULL UNIQUE
+        path NOT NULL UNIQUE,
+        path_hash NOT NULL
     );
 
-    CREATE VIRTUAL TABLE IF NOT EXISTS song USING fts4 (
-        audio_dir NOT NULL,
+    CREATE TABLE IF NOT EXISTS song (
+        audio_dir INTEGER NOT NULL,
         path NOT NULL,
         codec,
         quality,
         length_sec,
         filesize,
         mtime,
-        cover
+        cover,
+        UNIQUE(audio_dir, path)
     );
+    CREATE INDEX IF NOT EXISTS song_path ON song (path);
 
-    CREATE VIRTUAL TABLE IF NOT EXISTS tag USING fts4 (
-        song NOT NULL,
+    CREATE TABLE IF NOT EXISTS tag (
+        song INTEGER NOT NULL,
         field NOT NULL,
         value
     );
+    CREATE INDEX IF NOT EXISTS tag_song ON tag (song);
 
     CREATE TABLE IF NOT EXISTS cover (
         audio_dir NOT NULL,
         file_path NOT NULL,
-        data,
+        data_file,
         UNIQUE(audio_dir, file_path) ON CONFLICT IGNORE
     );
 """
 
+# Rows per multi-row tag INSERT, 3 variables each. Stays below 999, SQLite's default
+# limit on variables per statement before version 3.32.
+TAGS_PER_INSERT = 333
+
 DB_COMMANDS = {
+    "new song": """INSERT INTO song
+        (audio_dir, path, codec, quality, length_sec, filesize, mtime, cover)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+    "update song": """UPDATE song SET
+        codec = ?, quality = ?, length_sec = ?, filesize = ?, mtime = ?, cover = ?
+        WHERE ROWID = ?""",
     "new tag": "INSERT INTO tag VALUES (?, ?, ?)",
+    "new tags": "INSERT INTO tag VALUES " + ", ".join(["(?, ?, ?)"] * TAGS_PER_INSERT),
     "new cover": "INSERT INTO cover VALUES (?, ?, ?)",
-    "get audio dir id": "SELECT ROWID FROM audio_dir WHERE path_hash = ?",
-    "get song": "SELECT ROWID, * FROM song WHERE audio_dir = ? AND `path` = ?",
+    "get audio dir id": "SELECT ROWID FROM audio_dir WHERE path = ?",
+    "get songs": "SELECT ROWID, path, mtime, filesize FROM song WHERE audio_dir = ?",
     "get song tags": """SELECT field, value FROM tag
-        WHERE song in (SELECT rowid FROM song WHERE `path` = ?)""",
+        WHERE song in (SELECT ROWID FROM song WHERE `path` = ?)""",
     "clear db": """
         DROP TABLE IF EXISTS audio_dir;
         DROP TABLE IF EXISTS song;
         DROP TABLE IF EXISTS tag;
+        DROP TABLE IF EXISTS song_path; -- only in older layouts
         DROP TABLE IF EXISTS cover;
     """,
+    "get tags": "SELECT field, value FROM tag WHERE song = ?",
+    "get cover files": "SELECT DISTINCT data_file FROM cover",
     "clear song tags": "DELETE FROM tag WHERE song = ?",
 }
 
 
-def scan_audio_dir(audio_dir: str, db: sqlite3.Connection) -> None:
+class _LazyProcessPool:
+    """A process pool that only starts its workers when it gets work, with no more
+    workers than the first map() call has items, so that small updates don't start a
+    worker for each CPU, and an unchanged library none at all.
+    """
+
+    def __init__(self, max_workers: int):
+        self._max_workers = max_workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def map(self, fn: Callable, items: List[Any], chunksize: int = 1) -> Iterator[Any]:
+        if self._pool is None:
+            workers = max(1, min(self._max_workers, len(items)))
+            self._pool = ProcessPoolExecutor(workers)
+        return self._pool.map(fn, items, chunksize=chunksize)
+
+    def __enter__(self) -> "_LazyProcessPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+
+
+def scan_audio_dir(
+    audio_dir: str,
+    audio_dir_id: int,
+    changed_songs: Iterator[Tuple[str, os.stat_result, str, Optional[int]]],
+    db: sqlite3.Connection,
+    pool: _LazyProcessPool,
+) -> None:
+    """Scan the *changed_songs* of *audio_dir* (see _changed_songs()) into the database.
+    Parsing metadata is mostly CPU-bound Python code, so it's spread over the process
+    *pool*, while this process does all the database writes.
+    """
     cursor = db.cursor()
-    audio_dir_hash = path_hash(audio_dir)
-    audio_dir_id = _upsert(cursor, "audio_dir", {"path_hash": audio_dir_hash})
     last_prefix = ""
-    commit_every = 800  # rows
-    commit_cache_count = 0
+    batch_size = 800  # songs
+    tag_rows: List[Tuple[int, str, str]] = []
+    cover_ids: Dict[Tuple[str, Tuple[str, ...]], Optional[int]] = {}
+    # Songs are handed out in batches, so that not all of the library's metadata is
+    # loaded into memory at once. All writes for the audio dir go into a single
+    # transaction, committed at the end.
+    while True:
+        batch = list(islice(changed_songs, batch_size))
+        if not batch:
+            break
+        all_metadata = pool.map(
+            load_song_metadata, [song[2] for song in batch], chunksize=32
+        )
+        for (path, stat, abspath, prev_song_id), metadata in zip(batch, all_metadata):
+            first_sep = path.find("/")
+            prefix = path[:first_sep] if first_sep >= 0 else path
+            if last_prefix != prefix:
+                last_prefix = prefix
+                print(f"scanning {prefix!r}")
+            scan_song(
+                cursor,
+                audio_dir,
+                audio_dir_id,
+                path,
+                stat,
+                metadata,
+                tag_rows,
+                cover_ids,
+                prev_song_id,
+            )
+        _insert_tags(cursor, tag_rows)
+    db.commit()
+
+
+def _insert_tags(cursor: sqlite3.Cursor, tag_rows: List[Tuple[int, str, str]]) -> None:
+    """Insert all collected (song, field, value) rows at once and clear the list.
+    Rows are inserted TAGS_PER_INSERT at a time with a multi-row INSERT, which saves
+    most of the per-statement overhead, and the remainder one by one.
+
+    >>> db = sqlite3.connect(":memory:")
+    >>> cursor = db.cursor()
+    >>> _ = cursor.executescript(DB_LAYOUT)
+    >>> tag_rows = [(n, "track", str(n)) for n in range(2 * TAGS_PER_INSERT + 5)]
+    >>> _insert_tags(cursor, tag_rows)
+    >>> tag_rows
+    []
+    >>> cursor.execute("SELECT count(*), max(song) FROM tag").fetchone()
+    (671, 670)
+    >>> cursor.execute("SELECT value FROM tag WHERE song = 670").fetchone()
+    ('670',)
+    """
+    multi_end = len(tag_rows) - len(tag_rows) % TAGS_PER_INSERT
+    cursor.executemany(
+        DB_COMMANDS["new tags"],
+        (
+            list(chain.from_iterable(tag_rows[i : i + TAGS_PER_INSERT]))
+            for i in range(0, multi_end, TAGS_PER_INSERT)
+        ),
+    )
+    cursor.executemany(DB_COMMANDS["new tag"], tag_rows[multi_end:])
+    tag_rows.clear()
+
+
+def _changed_songs(
+    cursor: sqlite3.Cursor, audio_dir: str, audio_dir_id: int
+) -> Iterator[Tuple[str, os.stat_result, str, Optional[int]]]:
+    """Yield (path, stat, abspath, previous song id) for all songs in *audio_dir* that
+    are new or changed since the last scan.
+    """
+    # One query for all known songs instead of one per file.
+    db_songs = {
+        row["path"]: row
+        for row in cursor.execute(DB_COMMANDS["get songs"], (audio_dir_id,))
+    }
     for path, stat in list_files_relative(
         audio_dir, extensions=config.extensions, ignore_empty=True
     ):
-        db_song = cursor.execute(
-            DB_COMMANDS["get song"], (audio_dir_id, path)
-        ).fetchone()
+        db_song = db_songs.get(path)
         if (
             db_song is not None
             and db_song["mtime"] == int(stat.st_mtime)
             and db_song["filesize"] == stat.st_size
         ):
             continue
-        abspath = os.path.join(audio_dir, path)
-        first_sep = path.find("/")
-        prefix = path[:first_sep] if first_sep >= 0 else path
-        if last_prefix != prefix:
-            last_prefix = prefix
-            print(f"scanning {prefix!r}")
-
         prev_song_id = db_song["ROWID"] if db_song is not None else None
-        success = scan_song(
-            cursor, audio_dir, audio_dir_id, path, stat, abspath, prev_song_id
-        )
-        if success:
-            commit_cache_count += 1
-            if commit_cache_count >= commit_every:
-                commit_cache_count = 0
-                db.commit()
-    db.commit()
+        yield path, stat, os.path.join(audio_dir, path), prev_song_id
+
+
+class SongMetadata(NamedTuple):
+    """The parts of an audio file's metadata that go into the database."""
+
+    tags: List[Tuple[str, str]]
+    cover_hints: List[str]
+    codec: str
+    quality: int
+    length: float
+
+
+def load_song_metadata(abspath: str) -> Optional[SongMetadata]:
+    """Read the metadata of an audio file. Return None if it cannot be read.
+    Runs in the scan's worker processes, so it only returns plain, picklable data.
+    """
+    try:
+        if abspath.lower().endswith("mp3"):
+            data = MP3(abspath, ID3=EasyID3)
+        else:
+            data = mutagen.File(abspath)
+    except mutagen.MutagenError as err:
+        print(f"Warning, could not scan metadata: {abspath!r}", file=sys.stderr)
+        return None
+    if data is None:
+        return None
+    song_tags: List[Tuple[str, str]] = []
+    cover_hints: List[str] = []
+    for tag, values in data.items():
+        if tag in _SKIPPED_TAGS:
+            continue
+        if tag in _COVER_HINT_TAGS:
+            cover_hints += [str(value) for value in values]
+        # TODO(jakob): What should be done with multiple values for a tag?
+        # Separated with comma? Slash? For now, only use the first value.
+        value = _tag_value(values[0])
+        if value is not None:
+            song_tags.append((tag, value))
+    return SongMetadata(
+        tags=song_tags,
+        cover_hints=cover_hints,
+        codec=mimes_to_codec(tuple(data.mime)),
+        quality=data.info.bitrate if hasattr(data.info, "bitrate") else 0,
+        length=data.info.length,
+    )
+
+
+def _tag_value(value: Any) -> Optional[str]:
+    """Return a tag value as text without control characters, or None for binary values,
+    like embedded MP4 cover images (MP4Cover is a bytes subclass), which don't belong
+    in the tag table.
+
+    >>> _tag_value("Song\\x01 1")
+    'Song 1'
+    >>> _tag_value((3, 12))
+    '(3, 12)'
+    >>> _tag_value(b"\\xff\\xd8") is None
+    True
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return None
+    return str(value).translate(_CONTROL_CHARS)
 
 
 def scan_song(
@@ -105,50 +294,83 @@ def scan_song(
     audio_dir_id: int,
     path: str,
     stat: os.stat_result,
-    abspath: str,
-    prev_song_id: int = None,
+    metadata: Optional[SongMetadata],
+    tag_rows: List[Tuple[int, str, str]],
+    cover_ids: Dict[Tuple[str, Tuple[str, ...]], Optional[int]],
+    prev_song_id: Optional[int] = None,
 ) -> bool:
-    try:
-        if path.lower().endswith("mp3"):
-            data = MP3(abspath, ID3=EasyID3)
-        else:
-            data = mutagen.File(abspath)
-    except mutagen.MutagenError as err:
-        print(f"Warning, could not scan metadata: {abspath!r}", file=sys.stderr)
-        return False
-    if data is not None:
-        song_tags: MutableMapping[str, str] = {}
-        cover_hints: List[str] = []
-        for tag, values in data.items():
-            # TODO(jakob): What should be done with multiple values for a tag?
-            # Separated with comma? Slash? For now, only use the first value.
-            clean_first_value = "".join([c for c in values[0] if ord(c) >= 0x20])
-            if tag in ["path", "codec", "filesize", "mtime"]:
-                continue
-            if tag in ["artist", "album", "album_artist", "albumartist"]:
-                cover_hints += values
-            song_tags[tag] = clean_first_value
-        cover_id = scan_song_coverart(cursor, audio_dir, path, cover_hints)
-        codec = mimes_to_codec(data.mime)
-        quality = data.info.bitrate if hasattr(data.info, "bitrate") else 0
-        length = data.info.length
-        song_id = _upsert(
-            cursor,
-            "song",
-            {"audio_dir": audio_dir_id, "path": path},
-            {
-                "codec": codec,
-                "quality": quality,
-                "length_sec": length,
-                "filesize": stat.st_size,
-                "mtime": int(stat.st_mtime),
-                "cover": cover_id,
-            },
+    """Write a song's metadata to the database. The song's tags are not inserted right
+    away, but appended to *tag_rows*, to be inserted in bulk with _insert_tags().
+    Cover ids are remembered in *cover_ids* per directory and cover hints, so that the
+    other songs of an album don't search for and write the same cover again.
+
+    >>> db = sqlite3.connect(":memory:")
+    >>> cursor = db.cursor()
+    >>> _ = cursor.executescript(DB_LAYOUT)
+    >>> metadata = SongMetadata([("title", "Song")], [], "flac", 0, 1.0)
+    >>> stat = os.stat_result((0,) * 10)
+    >>> tag_rows, cover_ids = [], {("a", ()): None}  # no cover search
+    >>> scan_song(cursor, "/music", 1, "a/s.flac", stat, metadata, tag_rows, cover_ids)
+    True
+    >>> tag_rows
+    [(1, 'title', 'Song')]
+    >>> _insert_tags(cursor, tag_rows)
+
+    Rescanning the song with unchanged tags leaves them alone:
+
+    >>> args = ("/music", 1, "a/s.flac", stat, metadata, tag_rows, cover_ids, 1)
+    >>> scan_song(cursor, *args)
+    True
+    >>> tag_rows
+    []
+    >>> cursor.execute("SELECT ROWID, value FROM tag").fetchall()
+    [(1, 'Song')]
+
+    Changed tags replace the old ones:
+
+    >>> metadata = metadata._replace(tags=[("title", "Song 2")])
+    >>> args = ("/music", 1, "a/s.flac", stat, metadata, tag_rows, cover_ids, 1)
+    >>> scan_song(cursor, *args)
+    True
+    >>> cursor.execute("SELECT count(*) FROM tag").fetchone()[0], tag_rows
+    (0, [(1, 'title', 'Song 2')])
+    """
+    if metadata is not None:
+        cover_key = (os.path.dirname(path), tuple(metadata.cover_hints))
+        try:
+            cover_id = cover_ids[cover_key]
+        except KeyError:
+            cover_id = cover_ids[cover_key] = scan_song_coverart(
+                cursor, audio_dir, path, metadata.cover_hints
+            )
+        song_values = (
+            metadata.codec,
+            metadata.quality,
+            metadata.length,
+            stat.st_size,
+            int(stat.st_mtime),
         )
+        # Whether the song is already known is clear from the scan, so there's no need
+        # for _upsert().
         if prev_song_id is not None:
-            cursor.execute(DB_COMMANDS["clear song tags"], (prev_song_id,))
-        for tag, value in song_tags.items():
-            cursor.execute(DB_COMMANDS["new tag"], (song_id, tag, value))
+            song_id = prev_song_id
+            cursor.execute(
+                DB_COMMANDS["update song"], song_values + (cover_id, song_id)
+            )
+            # Files are often touched without changing their tags, e.g. when only the
+            # audio data or the cover was edited. Only rewrite the tags if they differ.
+            prev_tags = cursor.execute(DB_COMMANDS["get tags"], (song_id,))
+            if {tuple(row) for row in prev_tags} == set(metadata.tags):
+                return True
+            cursor.execute(DB_COMMANDS["clear song tags"], (song_id,))
+        else:
+            new_song_id = cursor.execute(
+                DB_COMMANDS["new song"],
+                (audio_dir_id, path) + song_values + (cover_id,),
+            ).lastrowid
+            assert new_song_id is not None  # always set after an INSERT
+            song_id = new_song_id
+        tag_rows.extend((song_id, tag, value) for tag, value in metadata.tags)
         return True
     return False
 
@@ -156,20 +378,17 @@ def scan_song(
 def scan_song_coverart(
     cursor: sqlite3.Cursor, audio_dir: str, path: str, cover_hints: Iterable[str]
 ):
-    # Maybe cover image data should not actually be in DB but rather in actual
-    # files?
+    # The image data itself is kept in a file in the covers dir, see
+    # CoverArt.save_data(), the database only stores that file's name.
     try:
         cover = CoverArt(audio_dir, path, cover_hints)
-        image_data = cover.get_data()
+        data_file = cover.save_data(config.covers_dir)
         cover_id = _upsert(
             cursor,
             "cover",
             {"audio_dir": audio_dir, "file_path": cover.image_path},
-            {"data": image_data},
+            {"data_file": data_file},
         )
-        # cursor.execute(
-        #     DB_COMMANDS["new cover"], (audio_dir, cover.image_path, image_data),
-        # )
         return cover_id
     except CoverNotFoundError:
         pass
@@ -178,15 +397,67 @@ def scan_song_coverart(
 def update_database() -> None:
     db = sqlite3.connect(config.database_file)
     db.row_factory = sqlite3.Row
-    db.cursor().executescript(DB_LAYOUT)
-    for audio_dir in config.audio:
-        scan_audio_dir(audio_dir, db)
+    # The database can always be rebuilt with a rescan, so trade a little durability on
+    # power loss for fewer fsyncs.
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-65536")  # KiB
+    db.execute("PRAGMA mmap_size=268435456")  # bytes
+    # The scan is the only writer, so take the file lock once and keep it instead of
+    # locking and unlocking for every transaction. Closing the database releases it.
+    db.execute("PRAGMA locking_mode=EXCLUSIVE")
+    # The layout only needs to be created when the version changes (or the database is
+    # new), an up-to-date database skips all DDL.
+    if db.execute("PRAGMA user_version").fetchone()[0] != DB_VERSION:
+        db.cursor().executescript(DB_COMMANDS["clear db"])
+        db.cursor().executescript(DB_LAYOUT)
+        db.execute(f"PRAGMA user_version = {DB_VERSION}")
+    cursor = db.cursor()
+    # A single pool for all audio dirs, so that its worker processes are only forked
+    # once.
+    with _LazyProcessPool(SCAN_PROCESSES) as pool:
+        for audio_dir in config.audio:
+            audio_dir_id = _upsert(
+                cursor,
+                "audio_dir",
+                {"path": audio_dir},
+                # The wants file refers to audio dirs by this hash, see get_wants()
+                {"path_hash": path_hash(audio_dir)},
+            )
+            changed_songs = _changed_songs(cursor, audio_dir, audio_dir_id)
+            scan_audio_dir(audio_dir, audio_dir_id, changed_songs, db, pool)
+    _remove_unused_covers(db)
     db.close()
 
 
+def _remove_unused_covers(db: sqlite3.Connection) -> None:
+    """Delete the files in the covers dir that no cover in the database refers to, e.g.
+    because the cover image changed or the database was rebuilt. Otherwise they would
+    keep being synced.
+    Only cover files are deleted, anything else in the covers dir is left alone, even
+    if the dir is shared with other files, like the database.
+    """
+    used = {row[0] for row in db.execute(DB_COMMANDS["get cover files"])}
+    try:
+        with os.scandir(config.covers_dir) as entries:
+            unused = [
+                e.path
+                for e in entries
+                if e.name not in used
+                and COVER_FILE_RE.fullmatch(e.name)
+                and e.is_file()
+            ]
+    except FileNotFoundError:
+        return
+    for path in unused:
+        try:
+            os.remove(path)
+        except OSError as err:
+            print(f"Warning, could not remove {path!r}:", err, file=sys.stderr)
+
+
 def get_song_tags(path: str) -> dict:
-    db = sqlite3.connect(config.database_file)
-    cursor = db.cursor()
+    cursor = _read_connection().cursor()
     tags = {}
     cursor.execute(DB_COMMANDS["get song tags"], (path,))
     for field, value in cursor.fetchall():
@@ -194,8 +465,27 @@ def get_song_tags(path: str) -> dict:
     return tags
 
 
+def _read_connection() -> sqlite3.Connection:
+    """Return this thread's connection for reading from the database, so that lookups
+    don't have to open the database file each time. sqlite3 connections can't be shared
+    between threads, so each thread opens its own on first use.
+    """
+    db = getattr(_thread_local, "db", None)
+    if db is None:
+        db = _thread_local.db = sqlite3.connect(config.database_file)
+        db.execute("PRAGMA mmap_size=268435456")  # bytes
+        db.execute("PRAGMA cache_size=-16384")  # KiB
+    return db
+
+
+@lru_cache(maxsize=None)
 def path_hash(path: str) -> str:
-    """Return the first 10 digits of the sha256 hash of the utf8-encoded path string."""
+    """
+    Return the first 10 digits of the sha256 hash of the utf8-encoded path string.
+
+    The hash is part of the wants-file format, so it can't be swapped for a cheaper
+    one. There are only ever a few audio dirs, so remember the results instead.
+    """
     # *One* digit would probably be enough, but let's be generous :)
     return sha256(path.encode()).hexdigest()[:10]
 
@@ -208,16 +498,17 @@ def _upsert(
 ) -> int:
     """
     SQlite's INSERT OR REPLACE method creates a new rowid, even if the row existed
-    before. To keep the rowid, one has to do the whole song-and-dance with select-then-
-    update-or-insert, which is what this function does.
+    before. To keep the rowid, this function uses a single INSERT ... ON CONFLICT DO
+    UPDATE ... RETURNING statement, or, with SQLite versions older than 3.35, the whole
+    song-and-dance with select-then-update-or-insert.
 
-    Any values in the *values* dict will be matched in the SELECT query. Any other
-    values, that (in the case of a new row) need to be filled, should be passed in the
-    *extra* dict.
+    Any values in the *values* dict will be matched against existing rows, and must be
+    covered by a UNIQUE constraint of the table. Any other values, that (in the case of
+    a new row) need to be filled, should be passed in the *extra* dict.
 
     >>> db = sqlite3.connect(":memory:")
     >>> cursor = db.cursor()
-    >>> cursor.execute("CREATE TABLE fs(path, descr)")
+    >>> cursor.execute("CREATE TABLE fs(path UNIQUE, descr)")
     <sqlite3.Cursor object ...
     >>> _upsert(cursor, "fs", {"path": "/"}, {"descr": "root"})
     1
@@ -232,39 +523,109 @@ def _upsert(
     """
     if extra is None:
         extra = {}
-    select = f"SELECT ROWID FROM {table} WHERE " + " AND ".join(
-        [f"`{k}`=:{k}" for k in values]
-    )
+    if _SQLITE_HAS_RETURNING:
+        upsert = _native_upsert_statement(table, tuple(values), tuple(extra))
+        return cursor.execute(upsert, {**values, **extra}).fetchone()[0]
+    return _select_then_upsert(cursor, table, values, extra)
+
+
+def _select_then_upsert(
+    cursor: sqlite3.Cursor,
+    table: str,
+    values: MutableMapping[str, Any],
+    extra: MutableMapping[str, Any],
+) -> int:
+    """The _upsert() for SQLite versions without RETURNING (older than 3.35).
+
+    >>> db = sqlite3.connect(":memory:")
+    >>> cursor = db.cursor()
+    >>> cursor.execute("CREATE TABLE fs(path UNIQUE, descr)")
+    <sqlite3.Cursor object ...
+    >>> _select_then_upsert(cursor, "fs", {"path": "/"}, {"descr": "root"})
+    1
+    >>> _select_then_upsert(cursor, "fs", {"path": "/etc"}, {})
+    2
+    >>> _select_then_upsert(cursor, "fs", {"path": "/"}, {"descr": "root dir"})
+    1
+    >>> _select_then_upsert(cursor, "fs", {"path": "/etc"}, {})
+    2
+    >>> cursor.execute("SELECT path, descr FROM fs ORDER BY ROWID").fetchall()
+    [('/', 'root dir'), ('/etc', None)]
+    """
+    select, update, insert = _upsert_statements(table, tuple(values), tuple(extra))
     result = cursor.execute(select, values).fetchone()
     if result is not None:
         if extra:
-            update = (
-                f"UPDATE {table} SET "
-                + ", ".join([f"`{k}` = :{k}" for k in extra])
-                + " WHERE "
-                + " AND ".join([f"`{k}` = :{k}" for k in values])
-            )
-            values.update(extra)
-            cursor.execute(update, values)
+            cursor.execute(update, {**extra, "upsert_rowid": result[0]})
         return result[0]
     else:
         values.update(extra)
-        insert = (
-            f"INSERT INTO {table} ("
-            + ", ".join([f"`{k}`" for k in values])
-            + ") VALUES ("
-            + ", ".join([f":{k}" for k in values])
-            + ")"
-        )
         return cursor.execute(insert, values).lastrowid
 
 
-def mimes_to_codec(mimes: List[str]) -> str:
-    """Utility function for turning mutagen's mime types into a single codec string."""
-    if any(["codecs=opus" in m for m in mimes]):
-        return "opus"
-    else:
-        return mimes[0].replace("audio/", "")
+@lru_cache(maxsize=None)
+def _upsert_statements(
+    table: str, keys: Tuple[str, ...], extra_keys: Tuple[str, ...]
+) -> Tuple[str, str, str]:
+    """Build the SELECT, UPDATE and INSERT statements for _upsert() once per table and
+    set of columns. The UPDATE addresses the row by its rowid, which is a direct
+    lookup.
+    """
+    select = f"SELECT ROWID FROM {table} WHERE " + " AND ".join(
+        [f"`{k}`=:{k}" for k in keys]
+    )
+    update = (
+        f"UPDATE {table} SET "
+        + ", ".join([f"`{k}` = :{k}" for k in extra_keys])
+        + " WHERE ROWID = :upsert_rowid"
+    )
+    insert = (
+        f"INSERT INTO {table} ("
+        + ", ".join([f"`{k}`" for k in keys + extra_keys])
+        + ") VALUES ("
+        + ", ".join([f":{k}" for k in keys + extra_keys])
+        + ")"
+    )
+    return select, update, insert
+
+
+@lru_cache(maxsize=None)
+def _native_upsert_statement(
+    table: str, keys: Tuple[str, ...], extra_keys: Tuple[str, ...]
+) -> str:
+    """Build the INSERT ... ON CONFLICT statement for _upsert() once per table and set
+    of columns. Without extra columns, the conflicting row is "updated" with its own key
+    so that RETURNING still yields its rowid, which DO NOTHING would not.
+    """
+    columns = keys + extra_keys
+    update_keys = extra_keys or keys[:1]
+    return (
+        f"INSERT INTO {table} ("
+        + ", ".join([f"`{k}`" for k in columns])
+        + ") VALUES ("
+        + ", ".join([f":{k}" for k in columns])
+        + ") ON CONFLICT ("
+        + ", ".join([f"`{k}`" for k in keys])
+        + ") DO UPDATE SET "
+        + ", ".join([f"`{k}` = excluded.`{k}`" for k in update_keys])
+        + " RETURNING ROWID"
+    )
+
+
+@lru_cache(maxsize=256)
+def mimes_to_codec(mimes: Tuple[str, ...]) -> str:
+    """Utility function for turning mutagen's mime types into a single codec string.
+    Cached, since most songs in a library share the same few mime type lists.
+
+    >>> mimes_to_codec(("audio/flac", "audio/x-flac", "application/x-flac"))
+    'flac'
+    >>> mimes_to_codec(("audio/ogg", "audio/ogg; codecs=opus"))
+    'opus'
+    """
+    for m in mimes:
+        if "codecs=opus" in m:
+            return "opus"
+    return mimes[0][6:] if mimes[0].startswith("audio/") else mimes[0]
 
 
 if __name__ == "__main__":
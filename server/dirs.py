@@ -1,42 +1,64 @@
 import os
 
 
-def list_files_absolute(start_dir, extensions=None, ignore_empty=False):
+def list_files_absolute(
+    start_dir, extensions=None, ignore_empty=False, paths_only=False
+):
     start_dir = os.path.expanduser(start_dir)
-    return _list_files(start_dir, start_dir, extensions, ignore_empty=ignore_empty)
+    return _list_files(
+        start_dir, extensions, ignore_empty=ignore_empty, paths_only=paths_only
+    )
 
 
-def list_files_relative(start_dir, extensions=None, ignore_empty=False):
+def list_files_relative(
+    start_dir, extensions=None, ignore_empty=False, paths_only=False
+):
     start_dir = os.path.expanduser(start_dir)
     return _list_files(
-        start_dir, start_dir, extensions, relative=True, ignore_empty=ignore_empty
+        start_dir,
+        extensions,
+        relative=True,
+        ignore_empty=ignore_empty,
+        paths_only=paths_only,
     )
 
 
 def _list_files(
-    start_dir, cur_dir, extensions=None, relative=False, ignore_empty=False
+    start_dir, extensions=None, relative=False, ignore_empty=False, paths_only=False
 ):
-    paths = []
-    with os.scandir(cur_dir) as scanner:
-        for entry in scanner:
-            if entry.is_dir():
-                paths += _list_files(
-                    start_dir,
-                    entry.path,
-                    extensions,
-                    relative=relative,
-                    ignore_empty=ignore_empty,
-                )
-            elif (
-                (
-                    extensions is not None
-                    and any([entry.name.endswith("." + ext) for ext in extensions])
-                )
-                or extensions is None
-            ) and ((ignore_empty and entry.stat().st_size > 0) or not ignore_empty):
-                if relative:
-                    name = os.path.relpath(entry.path, start=start_dir)
-                else:
-                    name = entry.path
-                paths.append((name, entry.stat()))
-    return paths
+    """Yield (path, stat) for all files below *start_dir*, depth-first, or only the
+    paths if *paths_only* is set.
+    Files are yielded while walking, so callers can start working on the first ones
+    before the whole tree has been listed.
+    Symlinked dirs are followed, but each dir is only listed once, so that symlink loops
+    end. They are listed after all others, so that files are found under their real
+    path, if they have one below *start_dir*.
+    """
+    suffixes = None if extensions is None else tuple("." + ext for ext in extensions)
+    start_stat = os.stat(start_dir)
+    dirs = [(start_dir, (start_stat.st_dev, start_stat.st_ino))]
+    linked_dirs = []
+    visited = set()
+    while dirs or linked_dirs:
+        cur_dir, dir_id = dirs.pop() if dirs else linked_dirs.pop()
+        if dir_id in visited:
+            continue
+        visited.add(dir_id)
+        with os.scandir(cur_dir) as scanner:
+            for entry in scanner:
+                if entry.is_dir():
+                    dir_stat = entry.stat()
+                    subdir = (entry.path, (dir_stat.st_dev, dir_stat.st_ino))
+                    if entry.is_symlink():
+                        linked_dirs.append(subdir)
+                    else:
+                        dirs.append(subdir)
+                elif suffixes is None or entry.name.endswith(suffixes):
+                    stat = entry.stat() if ignore_empty or not paths_only else None
+                    if ignore_empty and stat.st_size == 0:
+                        continue
+                    if relative:
+                        name = os.path.relpath(entry.path, start=start_dir)
+                    else:
+                        name = entry.path
+                    yield name if paths_only else (name, stat)
@@ -4,6 +4,7 @@ import os
 import sys
 import pwd
 from argparse import ArgumentParser
+from functools import lru_cache
 from typing import Iterable
 
 
@@ -32,28 +33,28 @@ def install_service(
             at = ""
             systemd_unit_dir = os.path.expanduser("~/.local/share/systemd/user/")
             os.makedirs(systemd_unit_dir, exist_ok=True)
-        write_systemd_unit_file(
-            os.path.join(systemd_unit_dir, f"songfone{at}.path"),
-            SYSTEMD_PATH_TEMPLATE,
-            path_modified_lines="\n".join([f"PathModified={a}" for a in watch_paths]),
-        )
-        write_systemd_unit_file(
-            os.path.join(systemd_unit_dir, f"songfone{at}.timer"),
-            SYSTEMD_TIMER_TEMPLATE,
-        )
-        write_systemd_unit_file(
-            os.path.join(systemd_unit_dir, f"songfone{at}.service"),
-            SYSTEMD_SERVICE_TEMPLATE,
-            user_line="User=%I" if i_am_root else "",
-            songfone_path=os.path.dirname(os.path.realpath(__file__)),
-        )
+        # All units are rendered before any is written, so that a template error
+        # leaves the installed units alone. A failing write or enable step can still
+        # leave some units installed.
+        units = {
+            f"songfone{at}.path": SYSTEMD_PATH_TEMPLATE.format(
+                path_modified_lines="\n".join(f"PathModified={a}" for a in watch_paths)
+            ),
+            f"songfone{at}.timer": SYSTEMD_TIMER_TEMPLATE,
+            f"songfone{at}.service": SYSTEMD_SERVICE_TEMPLATE.format(
+                user_line="User=%I" if i_am_root else "",
+                songfone_path=os.path.dirname(os.path.realpath(__file__)),
+            ),
+        }
+        for name, content in units.items():
+            write_systemd_unit_file(os.path.join(systemd_unit_dir, name), content)
     else:
         raise NotImplementedError("OS {sys.platform} not supported for service install")
 
 
-def write_systemd_unit_file(name: str, template: str, **kwargs) -> None:
+def write_systemd_unit_file(name: str, content: str) -> None:
     with open(name, "w") as file:
-        file.write(template.format(**kwargs))
+        file.write(content)
 
 
 def uninstall_service(i_am_root: bool = False) -> None:
@@ -81,19 +82,25 @@ def _expanduser_sudo(path: str) -> str:
     if path.startswith("~/"):
         sudo_user = os.getenv("SUDO_USER")
         if sudo_user is not None:
-            sudo_user_home = pwd.getpwnam(sudo_user).pw_dir
+            sudo_user_home = _home_dir(sudo_user)
             return path.replace("~/", sudo_user_home + "/", 1)
         else:
             raise Exception("$SUDO_USER is not set")
     elif path.startswith("~"):
         first_sep = path.find("/")
         user = path[1:first_sep] if first_sep >= 0 else path[1:]
-        user_home = pwd.getpwnam(user).pw_dir
+        user_home = _home_dir(user)
         return path.replace("~" + user, user_home, 1)
     else:
         return path
 
 
+@lru_cache(maxsize=None)
+def _home_dir(user: str) -> str:
+    """Look up a user's home dir only once, passwd lookups may go over the network."""
+    return pwd.getpwnam(user).pw_dir
+
+
 SYSTEMD_PATH_TEMPLATE = """[Unit]
 Description=songfone library path monitoring trigger
 
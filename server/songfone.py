@@ -25,8 +25,12 @@ def main(config_file=None):
     print(":: wanted files complete")
     update_database()
     print(":: database update complete")
-    while wants_changed_time < os.path.getmtime(config.wants_file):
-        wants_changed_time = os.path.getmtime(config.wants_file)
+    # Catch up with changes to the wants file made while this run was busy.
+    while True:
+        changed_time = os.path.getmtime(config.wants_file)
+        if changed_time <= wants_changed_time:
+            break
+        wants_changed_time = changed_time
         fulfill_wants()
 
 
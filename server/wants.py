@@ -1,28 +1,37 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import json
+from operator import attrgetter
 import os
 import shutil
 import sys
-from typing import Iterable, Union, Tuple, List, Set, Optional
+from typing import Callable, Dict, Iterable, Union, Tuple, List, Set, Optional
 
 from config import config
 from dirs import list_files_relative
 from conversion import Conversion
 from database import path_hash
 
+MAX_CONVERSION_BATCH_SIZE = 8  # Songs converted by a single ffmpeg process
+
 
 class WantsFileParseError(ValueError):
     pass
 
 
 class Want:
+    __slots__ = ("conversion", "audio_dir", "path", "src_path", "have")
+
     def __init__(self, audio_dir: str, path: str, conversion: Conversion = None):
         self.conversion = conversion
         self.audio_dir = audio_dir
         self.path = path
         if self.conversion is not None:
-            self.src_path = self.path
-            self.path = os.path.splitext(self.path)[0] + "." + self.conversion.ext
+            self.src_path = path
+            # Like os.path.splitext(), but without its overhead for each want.
+            dot = path.rfind(".")
+            if dot > path.rfind("/") + 1:
+                path = path[:dot]
+            self.path = path + self.conversion.dot_ext
         self.have = False
 
     def __hash__(self):
@@ -45,8 +54,11 @@ class Want:
         >>> set([w, v]) - set(["p", "q"])
         {Want('', 's')}
         """
-        if isinstance(other, Want):
-            return self.path == other.path and self.audio_dir == self.audio_dir
+        # Comparisons with plain path strings are the most common, check those first.
+        if type(other) is str:
+            return self.path == other
+        elif isinstance(other, Want):
+            return self.path == other.path and self.audio_dir == other.audio_dir
         elif isinstance(other, str):
             return self.path == other
         elif isinstance(other, os.PathLike):
@@ -97,20 +109,22 @@ def get_wants() -> List[Want]:
         }
     """
     try:
-        with open(config.wants_file) as wants_file:
-            if wants_file.read().strip() == "":
-                raise json.JSONDecodeError("Empty file, expecting at least '{}'", "", 0)
-            wants_file.seek(0)
-            wants_data = json.load(wants_file)
+        with open(config.wants_file, "rb") as wants_file:
+            wants_json = wants_file.read()
+        if not wants_json.strip():
+            raise json.JSONDecodeError("Empty file, expecting at least '{}'", "", 0)
+        wants_data = json.loads(wants_json)
     except FileNotFoundError:
         return []
-    except json.JSONDecodeError as err:
+    except (json.JSONDecodeError, UnicodeDecodeError) as err:
         raise WantsFileParseError(err)
     wants = []
+    # Audio dirs by their hash, to resolve each want with a single lookup
+    audio_dirs = {path_hash(audio_dir): audio_dir for audio_dir in config.audio}
     wants_data_wants = wants_data["wants"] if "wants" in wants_data else []
     wants_data_wants_as = wants_data["wants_as"] if "wants_as" in wants_data else []
     for json_want in wants_data_wants:
-        want_dir, want_path = _split_json_want(json_want)
+        want_dir, want_path = _split_json_want(json_want, audio_dirs)
         if want_dir is None:
             continue
         wants.append(Want(want_dir, want_path))
@@ -119,81 +133,175 @@ def get_wants() -> List[Want]:
             want_conversion["codec"], want_conversion["quality"] * 1000
         )
         for json_want in want_conversion["files"]:
-            want_dir, want_path = _split_json_want(json_want)
+            want_dir, want_path = _split_json_want(json_want, audio_dirs)
             if want_dir is None:
                 continue
             wants.append(Want(want_dir, want_path, conversion))
     return wants
 
 
-def get_want_diffs(wants: Iterable[Want]) -> Tuple[List[str], List[Want]]:
-    have_paths = {
-        f[0]
-        for f in list_files_relative(
-            config.output, extensions=config.extensions, ignore_empty=True
+def get_have_paths() -> Set[str]:
+    """Return the paths of all audio files in the output dir."""
+    return set(
+        list_files_relative(
+            config.output,
+            extensions=config.extensions,
+            ignore_empty=True,
+            paths_only=True,
         )
-    }
-    want_paths = set(wants)
-    removed = have_paths - want_paths
-    added = want_paths - have_paths
-    sort_by_path = lambda w: w.path if isinstance(w, Want) else w
-    return sorted(removed, key=sort_by_path), sorted(added, key=sort_by_path)
+    )
+
+
+def get_want_diffs(
+    wants: Iterable[Want], have_paths: Optional[Set[str]] = None
+) -> Tuple[List[str], List[Want]]:
+    if have_paths is None:
+        have_paths = get_have_paths()
+    # Diff on plain path strings, which avoids Want.__eq__() in the set operations.
+    wants_by_path: Dict[str, Want] = {}
+    for want in wants:
+        wants_by_path.setdefault(want.path, want)
+    removed = have_paths - wants_by_path.keys()
+    added = [wants_by_path[path] for path in wants_by_path.keys() - have_paths]
+    return sorted(removed), sorted(added, key=attrgetter("path"))
 
 
 def remove_unwanted(removed: Iterable[str]) -> None:
+    output_prefix = config.output_prefix
+    target_dirs = set()
     for f in removed:
-        target = os.path.join(config.output, f)
+        target = output_prefix + f
         try:
             os.remove(target)
         except FileNotFoundError:
             pass
+        target_dirs.add(os.path.dirname(target))
+    # Remove emptied dirs only once all files are gone, and once per dir instead of per
+    # file. Deeper dirs go first, since removing them may empty their parents.
+    for target_dir in sorted(target_dirs, key=len, reverse=True):
         try:
-            os.removedirs(os.path.dirname(target))
+            os.removedirs(target_dir)
         except OSError:
             pass
 
 
 def add_wanted(added: Iterable[Want]) -> None:
-    for f in added:
-        target = os.path.join(config.output, f.path)
-        os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Songs of an album share their dir, so only create each dir once.
+    output_prefix = config.output_prefix
+    target_dirs = {os.path.dirname(output_prefix + f.path) for f in added}
+    for target_dir in target_dirs:
+        os.makedirs(target_dir, exist_ok=True)
 
-    for f in [a for a in added if a.conversion is None]:
-        target = os.path.join(config.output, f.path)
-        shutil.copy2(os.path.join(f.audio_dir, f.path), target)
+    # Each copy is a job of its own, conversions are batched per Conversion.
+    jobs: List[Tuple[Callable[[List[Want]], List[bool]], List[Want]]] = [
+        (_copy_wants, [f]) for f in added if f.conversion is None
+    ]
+    by_conversion: Dict[Conversion, List[Want]] = {}
+    for fc in added:
+        if fc.conversion is not None:
+            by_conversion.setdefault(fc.conversion, []).append(fc)
+    for conversion, conversion_wants in by_conversion.items():
+        # Spread the wants over all threads before making batches larger.
+        per_thread = -(-len(conversion_wants) // config.max_conversion_threads)
+        batch_size = max(1, min(MAX_CONVERSION_BATCH_SIZE, per_thread))
+        for i in range(0, len(conversion_wants), batch_size):
+            jobs.append((conversion.do_many, conversion_wants[i : i + batch_size]))
 
+    # Copies are I/O-bound and conversions CPU-bound, so running both in the same pool
+    # keeps it busy. Jobs are handed to the pool in waves, so that only a few are
+    # queued at any time instead of the whole backlog, and results are reported as
+    # they come in.
+    max_pending = config.max_conversion_threads * 2
     with ThreadPoolExecutor(config.max_conversion_threads) as pool:
-        conversion_path = {
-            pool.submit(fc.conversion.do, fc): fc.path
-            for fc in added
-            if fc.conversion is not None
-        }
-        for future in as_completed(conversion_path):
-            if not future.result():
-                print(
-                    f"Warning: Could not convert {conversion_path[future]!r}",
-                    file=sys.stderr,
-                )
+        pending: Dict[Future, List[Want]] = {}
+        for job, wants in jobs:
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                _report_failures(pending, done)
+            pending[pool.submit(job, wants)] = wants
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            _report_failures(pending, done)
 
 
-def fulfill_wants() -> None:
+def _copy_wants(wants: List[Want]) -> List[bool]:
+    """Put the audio files of unconverted *wants* into the output dir. Return a success
+    value for each want.
+    """
+    output_prefix = config.output_prefix
+    copy = _link_or_copy if config.link_files else _copy
+    results = []
+    for want in wants:
+        target = output_prefix + want.path
+        try:
+            copy(os.path.join(want.audio_dir, want.path), target)
+            results.append(True)
+        except OSError as err:
+            print(f"Warning: Could not copy {want.path!r}: {err}", file=sys.stderr)
+            results.append(False)
+    return results
+
+
+def _copy(src: str, dest: str) -> None:
+    """Copy *src* to *dest*, keeping the file times, but, unlike shutil.copy2(),
+    skipping permissions and extended attributes.
+    """
+    shutil.copyfile(src, dest)  # uses sendfile() where available
+    src_stat = os.stat(src)
+    os.utime(dest, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+
+
+def _link_or_copy(src: str, dest: str) -> None:
+    """Hard link *src* to *dest*, which takes no time or space regardless of the file
+    size. If that isn't possible, e.g. because the output dir is on another file
+    system, copy the file instead. Only used with the link_files option, see Config.
+    """
     try:
-        wants = get_wants()
-    except WantsFileParseError as err:
-        print(f"Error parsing wants file: {err}", file=sys.stderr)
-        return
-    removed, added = get_want_diffs(wants)
+        os.link(src, dest)
+    except OSError:
+        _copy(src, dest)
+
+
+def _report_failures(pending: Dict[Future, List[Want]], done: Set[Future]) -> None:
+    """Warn about failed conversions of the *done* futures and remove them from
+    *pending*. Failed copies were already reported, with their cause, by _copy_wants().
+    """
+    for future in done:
+        wants = pending.pop(future)
+        try:
+            results = future.result()
+        except Exception as err:
+            # Don't let one failed job abort the others.
+            paths = ", ".join(repr(want.path) for want in wants)
+            print(f"Error adding {paths}: {err}", file=sys.stderr)
+            continue
+        for want, success in zip(wants, results):
+            if not success and want.conversion is not None:
+                print(f"Warning: Could not convert {want.path!r}", file=sys.stderr)
+
+
+def fulfill_wants() -> None:
+    # Walk the output dir in the background while the wants file is parsed.
+    with ThreadPoolExecutor(1) as pool:
+        have_paths = pool.submit(get_have_paths)
+        try:
+            wants = get_wants()
+        except WantsFileParseError as err:
+            print(f"Error parsing wants file: {err}", file=sys.stderr)
+            return
+    removed, added = get_want_diffs(wants, have_paths.result())
     remove_unwanted(removed)
-    add_wanted([a for a in added if a.conversion is None])
-    add_wanted([a for a in added if a.conversion is not None])
+    add_wanted(added)
 
 
-def _split_json_want(json_want: str) -> Tuple[Optional[str], str]:
+def _split_json_want(
+    json_want: str, audio_dirs: Dict[str, str]
+) -> Tuple[Optional[str], str]:
     want_dir_hash, want_path = json_want.split(":", 1)
-    for audio_dir in config.audio:
-        if path_hash(audio_dir) == want_dir_hash:
-            return audio_dir, want_path
-    return None, ""
+    audio_dir = audio_dirs.get(want_dir_hash)
+    if audio_dir is None:
+        return None, ""
+    return audio_dir, want_path
 
 
 if __name__ == "__main__":